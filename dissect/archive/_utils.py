@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Optional
+
+
+class lockfree_cached_property:
+    """A lock-free variant of :func:`functools.cached_property`.
+
+    Before Python 3.12, :func:`functools.cached_property` serializes the first access of a property across all
+    instances of a class with a single lock. This variant computes the value without locking and stores it in the
+    instance ``__dict__``, so subsequent lookups bypass the descriptor entirely. In the rare case of a concurrent
+    first access, the value may be computed more than once.
+
+    Only use this for properties that are cheap and side-effect free to compute, such as conversions of already parsed
+    values. Properties that perform I/O on shared file-like objects must keep using :func:`functools.cached_property`,
+    as concurrent computations could interleave their reads.
+    """
+
+    def __init__(self, func: Callable[[Any], Any]):
+        self.func = func
+        self.attrname = None
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.attrname = name
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+
+        value = self.func(instance)
+        instance.__dict__[self.attrname] = value
+        return value
@@ -2,13 +2,18 @@ from __future__ import annotations
 
 import io
 import struct
+import sys
+from array import array
+from collections import OrderedDict
 from datetime import datetime
-from functools import cached_property, lru_cache
-from typing import BinaryIO, Callable, Iterator, Optional
+from functools import cached_property
+from threading import Lock
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple, Optional
 
 from dissect.util.stream import AlignedStream, BufferedStream, RelativeStream
 from dissect.util.ts import wintimestamp
 
+from dissect.archive._utils import lockfree_cached_property
 from dissect.archive.c_wim import (
     DECOMPRESSOR_MAP,
     FILE_ATTRIBUTE,
@@ -27,6 +32,47 @@ from dissect.archive.exceptions import (
 )
 
 DEFAULT_CHUNK_SIZE = 32 * 1024
+CHUNK_CACHE_SIZE = 32
+READAHEAD_CHUNKS = 8
+
+# Offset of the Streams field in a _DIRENTRY
+_DIRENTRY_STREAMS_OFFSET = 96
+# _DIRENTRY without the trailing FileName, with the ReparseTag/HardLink union as its ReparseTag variant
+_DIRENTRY_STRUCT = struct.Struct("<qIIqqqqqq20s4sIIHHH")
+# _RESHDR_DISK with the 7 byte size and flags combined into a single integer
+_RESHDR_DISK_STRUCT = struct.Struct("<QqqHI20s")
+# _STREAMENTRY without the trailing StreamName
+_STREAMENTRY_STRUCT = struct.Struct("<Q8x20sH")
+
+
+class _DirEntry(NamedTuple):
+    """Fields of a ``_DIRENTRY`` as unpacked by ``_DIRENTRY_STRUCT``.
+
+    Unlike the cstruct definition, the ``_Unknown`` field is named ``Unknown`` and ``ReparseTag`` is a plain integer.
+    """
+
+    Length: int
+    Attributes: FILE_ATTRIBUTE
+    SecurityId: int
+    SubdirOffset: int
+    Unused1: int
+    Unused2: int
+    CreationTime: int
+    LastAccessTime: int
+    LastWriteTime: int
+    Hash: bytes
+    Unknown: bytes
+    ReparseTag: int
+    ReparseReserved: int
+    Streams: int
+    ShortNameLength: int
+    FileNameLength: int
+
+    @property
+    def HardLink(self) -> int:
+        value = (self.ReparseReserved << 32) | self.ReparseTag
+        # HardLink is a LARGE_INTEGER, so interpret it as signed
+        return value - (1 << 64) if value & (1 << 63) else value
 
 
 class WIM:
@@ -37,10 +83,13 @@ class WIM:
 
     def __init__(self, fh: BinaryIO):
         self.fh = fh
-        self.header = c_wim.WIMHEADER_V1_PACKED(fh)
 
-        if self.header.ImageTag != WIM_IMAGE_TAG:
-            raise InvalidHeaderError(f"Expected MSWIM header, got: {self.header.ImageTag!r}")
+        # Check the image tag before parsing the rest of the header, so we fail fast on files that aren't WIM files
+        buf = fh.read(len(c_wim.WIMHEADER_V1_PACKED))
+        if (image_tag := buf[: len(WIM_IMAGE_TAG)]) != WIM_IMAGE_TAG:
+            raise InvalidHeaderError(f"Expected MSWIM header, got: {image_tag!r}")
+
+        self.header = c_wim.WIMHEADER_V1_PACKED(buf)
 
         if self.header.Version != c_wim.VERSION_DEFAULT:
             raise NotImplementedError(f"Only WIM version {c_wim.VERSION_DEFAULT:#x} is supported right now")
@@ -50,18 +99,43 @@ class WIM:
 
         self._resource_table, self._images = self._read_resource_table()
 
+    @classmethod
+    def sniff(cls, fh: BinaryIO) -> bool:
+        """Return whether the given file-like object looks like a WIM file.
+
+        Only the image tag at the current offset is checked, the offset of ``fh`` is restored afterwards.
+        """
+        offset = fh.tell()
+        try:
+            return fh.read(len(WIM_IMAGE_TAG)) == WIM_IMAGE_TAG
+        finally:
+            fh.seek(offset)
+
     def _read_resource_table(self) -> tuple[dict[bytes, Resource], list[Resource]]:
         # Read the resource table in one go and separate images out
-        # If this turns out to be slow for large WIM files, we can add some clever caching
         table = {}
         images = []
         with Resource.from_short_header(self, self.header.OffsetTable).open() as fh:
-            for _ in range(fh.size // len(c_wim._RESHDR_DISK)):
-                resource = Resource.from_header(self, c_wim._RESHDR_DISK(fh))
-                table[resource.hash] = resource
-
-                if resource.is_metadata:
-                    images.append(resource)
+            buf = fh.read()
+
+        # Ignore any trailing partial entry, iter_unpack requires a multiple of the entry size
+        buf = memoryview(buf)[: len(buf) - (len(buf) % _RESHDR_DISK_STRUCT.size)]
+        for fields in _RESHDR_DISK_STRUCT.iter_unpack(buf):
+            size_flags, offset, original_size, part_number, reference_count, resource_hash = fields
+            resource = Resource(
+                self,
+                size_flags & 0x00FFFFFFFFFFFFFF,
+                RESHDR_FLAG(size_flags >> 56),
+                offset,
+                original_size,
+                part_number,
+                reference_count,
+                resource_hash,
+            )
+            table[resource_hash] = resource
+
+            if resource.is_metadata:
+                images.append(resource)
 
         return table, images
 
@@ -70,6 +144,21 @@ class WIM:
         """Return the table of resources in the WIM file."""
         return self._resource_table
 
+    def resource_by_hash(self, resource_hash: bytes) -> Optional[Resource]:
+        """Return the resource with the given hash, or ``None`` if it doesn't exist."""
+        return self._resource_table.get(resource_hash)
+
+    def get_resource(self, resource_hash: bytes) -> Resource:
+        """Return the resource with the given hash.
+
+        Raises:
+            FileNotFoundError: If no resource with the given hash exists.
+        """
+        if (resource := self.resource_by_hash(resource_hash)) is None:
+            raise FileNotFoundError(f"Unable to find resource with hash {resource_hash.hex()}")
+
+        return resource
+
     def images(self) -> Iterator[Image]:
         """Iterate over all images in the WIM file."""
         for resource in self._images:
@@ -156,11 +245,17 @@ class Resource:
 class Image:
     def __init__(self, wim: WIM, fh: BinaryIO):
         self.wim = wim
+        self.fh = fh
+        # Serializes reads of directories from the shared metadata stream
+        self._lock = Lock()
         self.security = SecurityBlock(fh)
 
         offset = fh.tell()
-        fh.seek(offset + (-offset & 7))
-        self.root = DirectoryEntry(self, fh)
+        self.root = DirectoryEntry(self, memoryview(_read_directory(fh, offset + (-offset & 7))))
+
+        # Cache of paths looked up from the root, keyed by their components without empty and "." parts, joined by "\\"
+        # Directory entries are immutable so these never go stale
+        self._path_cache: dict[str, DirectoryEntry] = {}
 
     def __repr__(self) -> str:
         return "<Image>"
@@ -170,14 +265,18 @@ class Image:
         # `/` is an illegal character in NTFS filenames, so it's safe to replace
         search_path = path.replace("/", "\\")
 
-        parts = search_path.split("\\")
+        # Empty and "." components don't affect the result, so leave them out of the path and its cache key
+        parts = [part for part in search_path.split("\\") if part and part != "."]
+        cache_key = "\\".join(parts)
+
+        use_cache = entry is None
+        if use_cache and (cached := self._path_cache.get(cache_key)) is not None:
+            return cached
+
         entry = entry or self.root
         prev_entry = None
 
         for part in parts:
-            if not part or part == ".":
-                continue
-
             if part == "..":
                 entry = prev_entry or self.root
                 continue
@@ -186,14 +285,15 @@ class Image:
                 entry = self.get(entry.readlink(), prev_entry)
 
             # Traverse to the target path from our root node
-            for subentry in entry.iterdir():
-                if subentry.name == part:
-                    prev_entry = entry
-                    entry = subentry
-                    break
-            else:
+            if (subentry := entry._children.get(part)) is None:
                 raise FileNotFoundError(f"File not found: {path}")
 
+            prev_entry = entry
+            entry = subentry
+
+        if use_cache:
+            self._path_cache[cache_key] = entry
+
         return entry
 
 
@@ -201,60 +301,75 @@ class SecurityBlock:
     def __init__(self, fh: BinaryIO):
         self.header = c_wim._SECURITYBLOCK_DISK(fh)
         self.descriptors = []
+
+        # Read all descriptors in one go and slice them out
+        buf = fh.read(sum(self.header.EntryLength))
+        offset = 0
         for size in self.header.EntryLength:
             if size == 0:
                 continue
 
-            self.descriptors.append(fh.read(size))
+            self.descriptors.append(buf[offset : offset + size])
+            offset += size
 
 
 class DirectoryEntry:
-    def __init__(self, image: Image, fh: BinaryIO):
+    """A directory entry, parsed from a buffer containing one or more directory entries.
+
+    Any data between the end of the names and the end of the entry as given by its ``Length`` field is stored in
+    ``extra``, including any alignment padding that falls within that length. ``extra`` is ``None`` if there is none.
+
+    Args:
+        image: The image this directory entry belongs to.
+        buf: The buffer to parse the directory entry from.
+        offset: The offset of the directory entry in ``buf``. Must be 8 byte aligned.
+    """
+
+    def __init__(self, image: Image, buf: memoryview, offset: int = 0):
         self.image = image
-        self.fh = fh
 
-        start = fh.tell()
-        self.entry = c_wim._DIRENTRY(fh)
+        fields = _DIRENTRY_STRUCT.unpack_from(buf, offset)
+        self.entry = _DirEntry(fields[0], FILE_ATTRIBUTE(fields[1]), *fields[2:])
         self.name = None
         self.short_name = None
         self.extra = None
 
+        end = offset + self.entry.Length
+        cursor = offset + _DIRENTRY_STRUCT.size
+
         if length := self.entry.FileNameLength:
-            self.name = _read_name(fh, length)
-            fh.read(2)
+            self.name = buf[cursor : cursor + length].tobytes().decode("utf-16-le")
+            cursor += length + 2
 
         if length := self.entry.ShortNameLength:
-            self.short_name = _read_name(fh, length)
-            fh.read(2)
+            self.short_name = buf[cursor : cursor + length].tobytes().decode("utf-16-le")
+            cursor += length + 2
+
+        # If there's any trailing data after the names, store it
+        if cursor < end:
+            self.extra = buf[cursor:end].tobytes()
 
-        # If there's any trailing data after the aligned end, read it and store it
-        end = fh.tell()
-        if (length := self.entry.Length - (((end + 7) & (-8)) - start)) > 0 or (
-            length := self.entry.Length - (end - start)
-        ) > 0:
-            self.extra = fh.read(length)
+        # Stream entries follow the directory entry and are 8 byte aligned
+        cursor = (end + 7) & (-8)
 
         self.streams = {}
         if self.entry.Streams:
             for _ in range(self.entry.Streams):
-                # Stream entries are 8 byte aligned
-                fh.seek((fh.tell() + 7) & (-8))
-
                 name = ""
-                stream = c_wim._STREAMENTRY(fh)
-                if name_length := stream.StreamNameLength:
-                    name = _read_name(fh, name_length)
-                    name_length += 2
-                    fh.read(2)
+                length, stream_hash, name_length = _STREAMENTRY_STRUCT.unpack_from(buf, cursor)
+                if name_length:
+                    name_offset = cursor + _STREAMENTRY_STRUCT.size
+                    name = buf[name_offset : name_offset + name_length].tobytes().decode("utf-16-le")
 
-                self.streams[name] = stream.Hash
-
-                if remaining := stream.Length - len(c_wim._STREAMENTRY) - name_length:
-                    fh.read(remaining)
+                self.streams[name] = stream_hash
+                cursor = (cursor + length + 7) & (-8)
         else:
             # Add the entry hash as the default stream
             self.streams[""] = self.entry.Hash
 
+        # Offset of the next directory entry in the buffer
+        self._next_offset = cursor
+
     def __repr__(self) -> str:
         return f"<DirectoryEntry name={self.name!r}>"
 
@@ -287,7 +402,7 @@ class DirectoryEntry:
         if not self.is_reparse_point():
             raise NotAReparsePointError(f"{self} is not a reparse point")
 
-        return ReparsePoint(self.entry.ReparseTag, self.open())
+        return ReparsePoint(IO_REPARSE_TAG(self.entry.ReparseTag), self.open())
 
     def readlink(self) -> str:
         return self.reparse_point.substitute_name
@@ -297,60 +412,74 @@ class DirectoryEntry:
         with self.open(name) as fh:
             return fh.size
 
-    @cached_property
+    @lockfree_cached_property
     def creation_time(self) -> datetime:
         """Return the creation time."""
         return wintimestamp(self.entry.CreationTime)
 
-    @cached_property
+    @lockfree_cached_property
     def creation_time_ns(self) -> int:
         """Return the creation time in nanoseconds."""
         return _ts_to_ns(self.entry.CreationTime)
 
-    @cached_property
+    @lockfree_cached_property
     def last_access_time(self) -> datetime:
         """Return the last access time."""
         return wintimestamp(self.entry.LastAccessTime)
 
-    @cached_property
+    @lockfree_cached_property
     def last_access_time_ns(self) -> int:
         """Return the last access time in nanoseconds."""
         return _ts_to_ns(self.entry.LastAccessTime)
 
-    @cached_property
+    @lockfree_cached_property
     def last_write_time(self) -> datetime:
         """Return the last write time."""
         return wintimestamp(self.entry.LastWriteTime)
 
-    @property
+    @lockfree_cached_property
     def last_write_time_ns(self) -> int:
         """Return the last write time in nanoseconds."""
         return _ts_to_ns(self.entry.LastWriteTime)
 
+    @cached_property
+    def _entries(self) -> list[DirectoryEntry]:
+        """Parse and cache the directory contents."""
+        entries = []
+
+        # Read the directory in one go and parse the entries from memory
+        with self.image._lock:
+            buf = memoryview(_read_directory(self.image.fh, self.entry.SubdirOffset))
+        offset = 0
+        while offset < len(buf):
+            entry = DirectoryEntry(self.image, buf, offset)
+            entries.append(entry)
+            offset = entry._next_offset
+
+        return entries
+
+    @cached_property
+    def _children(self) -> dict[str, DirectoryEntry]:
+        """Return a cached mapping of the directory contents by name.
+
+        If multiple entries share a name, the first one wins, like a linear scan of the directory would.
+        """
+        children = {}
+        for entry in self.iterdir():
+            children.setdefault(entry.name, entry)
+
+        return children
+
     def listdir(self) -> dict[str, DirectoryEntry]:
         """Return a directory listing."""
-        return {entry.name: entry for entry in self.iterdir()}
+        return dict(self._children)
 
     def iterdir(self) -> Iterator[DirectoryEntry]:
         """Iterate directory contents."""
         if not self.is_dir():
             raise NotADirectoryError(f"{self!r} is not a directory")
 
-        fh = self.fh
-        fh.seek(self.entry.SubdirOffset)
-        while True:
-            length = int.from_bytes(fh.read(8), "little")
-            if length <= 8:
-                break
-
-            fh.seek(-8, io.SEEK_CUR)
-            entry = DirectoryEntry(self.image, fh)
-            offset = fh.tell()
-
-            yield entry
-
-            # Align to the next 8 byte boundary
-            fh.seek((offset + 7) & (-8))
+        yield from self._entries
 
     def open(self, name: str = "") -> BinaryIO:
         """Return a file-like object for the contents of this directory entry.
@@ -365,10 +494,33 @@ class DirectoryEntry:
         if stream_hash.strip(b"\x00") == b"":
             return BufferedStream(io.BytesIO(b""), size=0)
 
-        if resource := self.image.wim.resources.get(stream_hash):
-            return resource.open()
-        else:
-            raise FileNotFoundError(f"Unable to find resource for directory entry {self}")
+        try:
+            resource = self.image.wim.get_resource(stream_hash)
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"Unable to find resource for directory entry {self}") from e
+
+        return resource.open()
+
+    def hash(self, hasher: Any, name: str = "") -> Any:
+        """Update ``hasher`` with the contents of this directory entry, without reading it into memory at once.
+
+        Works for both compressed and uncompressed resources, e.g. ``entry.hash(hashlib.sha1()).hexdigest()``.
+
+        Args:
+            hasher: A hash object from :mod:`hashlib`, or any object with a compatible ``update`` method.
+            name: Optional alternate stream name to hash.
+
+        Returns:
+            The given ``hasher``.
+        """
+        with self.open(name) as fh:
+            if isinstance(fh, CompressedStream):
+                return fh.hash(hasher)
+
+            while buf := fh.read(DEFAULT_CHUNK_SIZE):
+                hasher.update(buf)
+
+        return hasher
 
 
 class ReparsePoint:
@@ -444,21 +596,64 @@ class CompressedStream(AlignedStream):
         if num_chunks == 0:
             self._chunks = (0,)
         else:
-            entry_size = "Q" if original_size > 0xFFFFFFFF else "I"
-            pattern = f"<{num_chunks}{entry_size}"
-            self._chunks = (0,) + struct.unpack(pattern, fh.read(struct.calcsize(pattern)))
+            # Keep the chunk table as a native array instead of a tuple of Python integers
+            self._chunks = array("Q" if original_size > 0xFFFFFFFF else "I", [0])
+            self._chunks.frombytes(fh.read(num_chunks * self._chunks.itemsize))
+            if sys.byteorder == "big":
+                self._chunks.byteswap()
 
         self._data_offset = fh.tell()
 
-        self._read_chunk = lru_cache(32)(self._read_chunk)
+        self._chunk_cache: OrderedDict[int, bytes] = OrderedDict()
+        # Compressed data of prefetched chunks, decompressed on first use
+        self._prefetch_cache: dict[int, bytes] = {}
+        self._last_read_end = None
         super().__init__(self.original_size)
 
     def _read(self, offset: int, length: int) -> bytes:
-        result = []
+        return b"".join(self._iter_chunk_data(offset, length))
+
+    def readinto(self, b: bytearray) -> int:
+        """Read bytes into a pre-allocated bytes-like object b, copying the decompressed chunks directly into it.
+
+        Returns an int representing the number of bytes read (0 for EOF).
+        """
+        # Only use the public stream interface, the internals of AlignedStream differ between dissect.util versions
+        offset = self.tell()
+        out = memoryview(b).cast("B")
+        pos = 0
+        for data in self._iter_chunk_data(offset, max(0, min(len(out), self.size - offset))):
+            out[pos : pos + len(data)] = data
+            pos += len(data)
+
+        self.seek(offset + pos)
+        return pos
+
+    def hash(self, hasher: Any) -> Any:
+        """Update ``hasher`` with the entire decompressed stream, one chunk at a time.
 
+        This avoids materializing the entire stream in memory, e.g. ``stream.hash(hashlib.sha1()).hexdigest()``.
+        Use :meth:`DirectoryEntry.hash` to hash a directory entry regardless of how its resource is stored.
+
+        Args:
+            hasher: A hash object from :mod:`hashlib`, or any object with a compatible ``update`` method.
+
+        Returns:
+            The given ``hasher``.
+        """
+        for data in self._iter_chunk_data(0, self.size):
+            hasher.update(data)
+
+        return hasher
+
+    def _iter_chunk_data(self, offset: int, length: int) -> Iterator[memoryview]:
+        """Yield the decompressed data in the given range, one chunk at a time."""
         num_chunks = len(self._chunks)
         chunk, offset_in_chunk = divmod(offset, DEFAULT_CHUNK_SIZE)
 
+        # Read ahead if this read continues where the previous one ended
+        readahead = READAHEAD_CHUNKS if offset == self._last_read_end else 0
+
         while length:
             if chunk >= num_chunks:
                 # We somehow requested more data than we have runs for
@@ -474,25 +669,96 @@ class CompressedStream(AlignedStream):
 
             read_length = min(chunk_remaining, length)
 
-            buf = self._read_chunk(chunk_offset, next_chunk_offset - chunk_offset)
-            result.append(buf[offset_in_chunk : offset_in_chunk + read_length])
+            if chunk_offset not in self._chunk_cache and chunk_offset not in self._prefetch_cache:
+                # Fetch all the chunks we still need for this read (and any readahead) in one go
+                count = (offset_in_chunk + length + DEFAULT_CHUNK_SIZE - 1) // DEFAULT_CHUNK_SIZE + readahead
+                if count > 1:
+                    self._prefetch_chunks(chunk, min(count, CHUNK_CACHE_SIZE))
+
+            buf = self._cached_read_chunk(chunk_offset, next_chunk_offset - chunk_offset)
+            yield memoryview(buf)[offset_in_chunk : offset_in_chunk + read_length]
 
             length -= read_length
             offset += read_length
+            self._last_read_end = offset
             chunk += 1
+            offset_in_chunk = 0
+
+    def _prefetch_chunks(self, start: int, count: int) -> None:
+        """Read the compressed data of ``count`` chunks starting at chunk ``start`` using a single read.
+
+        The chunks are only decompressed once they're actually read.
+        """
+        num_chunks = len(self._chunks)
+        end = min(start + count, num_chunks)
+
+        start_offset = self._chunks[start]
+        end_offset = self._chunks[end] if end < num_chunks else self.compressed_size
 
-        return b"".join(result)
+        self.fh.seek(self._data_offset + start_offset)
+        buf = self.fh.read(end_offset - start_offset)
+
+        self._prefetch_cache = {}
+        for chunk in range(start, end):
+            chunk_offset = self._chunks[chunk]
+            if chunk_offset in self._chunk_cache:
+                continue
+
+            next_chunk_offset = self._chunks[chunk + 1] if chunk + 1 < num_chunks else self.compressed_size
+            self._prefetch_cache[chunk_offset] = buf[chunk_offset - start_offset : next_chunk_offset - start_offset]
+
+    def _cached_read_chunk(self, offset: int, size: int) -> bytes:
+        if (buf := self._chunk_cache.get(offset)) is not None:
+            self._chunk_cache.move_to_end(offset)
+            return buf
+
+        if (buf := self._prefetch_cache.pop(offset, None)) is not None:
+            buf = self.decompressor(buf)
+        else:
+            buf = self._read_chunk(offset, size)
+
+        self._chunk_cache[offset] = buf
+        if len(self._chunk_cache) > CHUNK_CACHE_SIZE:
+            self._chunk_cache.popitem(last=False)
+
+        return buf
 
     def _read_chunk(self, offset: int, size: int) -> bytes:
         self.fh.seek(self._data_offset + offset)
         buf = self.fh.read(size)
         return self.decompressor(buf)
 
+    def close(self) -> None:
+        self._chunk_cache.clear()
+        self._prefetch_cache.clear()
+        super().close()
+
 
 def _ts_to_ns(ts: int) -> int:
     """Convert Windows timestamps to nanosecond timestamps."""
     return (ts * 100) - 11644473600000000000
 
 
-def _read_name(fh: BinaryIO, length: int) -> str:
-    return fh.read(length).decode("utf-16-le")
+def _read_directory(fh: BinaryIO, offset: int) -> bytes:
+    """Read all directory entries of a directory, including their stream entries, in a single read.
+
+    The returned buffer does not include the terminating empty entry.
+    """
+    end = offset
+    while True:
+        fh.seek(end)
+        length = int.from_bytes(fh.read(8), "little")
+        if length <= 8:
+            break
+
+        # Skip over the entry and any stream entries that follow it, all of which are 8 byte aligned
+        fh.seek(end + _DIRENTRY_STREAMS_OFFSET)
+        num_streams = int.from_bytes(fh.read(2), "little")
+        end = (end + length + 7) & (-8)
+
+        for _ in range(num_streams):
+            fh.seek(end)
+            end = (end + int.from_bytes(fh.read(8), "little") + 7) & (-8)
+
+    fh.seek(offset)
+    return fh.read(end - offset)
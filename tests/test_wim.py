@@ -1,7 +1,19 @@
 import hashlib
+import io
+import struct
 from typing import BinaryIO
 
-from dissect.archive.wim import WIM
+import pytest
+
+from dissect.archive.c_wim import FILE_ATTRIBUTE
+from dissect.archive.exceptions import FileNotFoundError, InvalidHeaderError
+from dissect.archive.wim import (
+    CHUNK_CACHE_SIZE,
+    DEFAULT_CHUNK_SIZE,
+    WIM,
+    CompressedStream,
+    DirectoryEntry,
+)
 
 
 def test_wim(basic_wim: BinaryIO) -> None:
@@ -20,6 +32,7 @@ def test_wim(basic_wim: BinaryIO) -> None:
     assert len(entry.streams) == 1
     assert entry.size() == 70
     assert hashlib.sha1(entry.open().read()).hexdigest() == "0aaa8266648364d68b67be77c53f708a77fda84c"
+    assert entry.hash(hashlib.sha1()).hexdigest() == "0aaa8266648364d68b67be77c53f708a77fda84c"
 
     entry = image.get("ads.txt")
     assert entry.is_file()
@@ -30,6 +43,7 @@ def test_wim(basic_wim: BinaryIO) -> None:
     assert entry.size("spookystream") == 38
     assert hashlib.sha1(entry.open().read()).hexdigest() == "8e2dbd4ff0c5e125b445ded476f5bb9637e115a6"
     assert hashlib.sha1(entry.open("spookystream").read()).hexdigest() == "0fb3109183dc351670bec54bebe6406ad016315e"
+    assert entry.hash(hashlib.sha1(), "spookystream").hexdigest() == "0fb3109183dc351670bec54bebe6406ad016315e"
 
     entry = image.get("link.txt")
     assert entry.is_file()
@@ -51,3 +65,260 @@ def test_wim(basic_wim: BinaryIO) -> None:
     assert len(entry.streams) == 1
     assert entry.size() == 60
     assert hashlib.sha1(entry.open().read()).hexdigest() == "1fc83a896287fe48f6d42d8d04f88f6dc90c0c45"
+
+
+def test_wim_resource_not_found(basic_wim: BinaryIO) -> None:
+    wim = WIM(basic_wim)
+
+    for resource_hash in wim.resources:
+        assert wim.get_resource(resource_hash).hash == resource_hash
+        assert wim.resource_by_hash(resource_hash) is wim.get_resource(resource_hash)
+
+    assert wim.resource_by_hash(b"\xff" * 20) is None
+    with pytest.raises(FileNotFoundError):
+        wim.get_resource(b"\xff" * 20)
+
+
+def test_wim_sniff(basic_wim: BinaryIO) -> None:
+    assert WIM.sniff(basic_wim)
+    assert basic_wim.tell() == 0
+
+    fh = io.BytesIO(b"\x00" * 512)
+    assert not WIM.sniff(fh)
+
+    with pytest.raises(InvalidHeaderError):
+        WIM(fh)
+
+
+class CountingBytesIO(io.BytesIO):
+    def __init__(self, buf: bytes):
+        super().__init__(buf)
+        self.reads = 0
+
+    def read(self, size: int = -1) -> bytes:
+        self.reads += 1
+        return super().read(size)
+
+
+def _compressed_stream(data: bytes) -> tuple[CompressedStream, CountingBytesIO, list[bytes]]:
+    # Build a chunk table for uncompressed chunks and "decompress" them with an identity function
+    num_chunks = (len(data) + DEFAULT_CHUNK_SIZE - 1) // DEFAULT_CHUNK_SIZE
+    table = b"".join(struct.pack("<I", i * DEFAULT_CHUNK_SIZE) for i in range(1, num_chunks))
+    buf = table + data
+
+    decompressed = []
+
+    def decompress(buf: bytes) -> bytes:
+        decompressed.append(buf)
+        return bytes(buf)
+
+    fh = CountingBytesIO(buf)
+    return CompressedStream(fh, 0, len(buf), len(data), decompress), fh, decompressed
+
+
+def _data(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
+def test_compressed_stream_read() -> None:
+    data = _data(3 * DEFAULT_CHUNK_SIZE + 1000)
+    stream, _, _ = _compressed_stream(data)
+
+    for offset, length in [
+        (0, 10),
+        (DEFAULT_CHUNK_SIZE - 8, 20),
+        (17611, 74606),
+        (100, 2 * DEFAULT_CHUNK_SIZE),
+        (3 * DEFAULT_CHUNK_SIZE, 1000),
+        (len(data) - 50, 100),
+        (len(data), 10),
+    ]:
+        stream.seek(offset)
+        assert stream.read(length) == data[offset : offset + length]
+
+    stream.seek(0)
+    assert stream.read() == data
+
+    # Reads starting partway into a chunk that span multiple chunks
+    assert stream._read(8192, 2 * DEFAULT_CHUNK_SIZE) == data[8192 : 8192 + 2 * DEFAULT_CHUNK_SIZE]
+    assert stream._read(3 * DEFAULT_CHUNK_SIZE + 500, 8192) == data[3 * DEFAULT_CHUNK_SIZE + 500 :]
+
+
+def test_compressed_stream_cache() -> None:
+    data = _data((CHUNK_CACHE_SIZE + 1) * DEFAULT_CHUNK_SIZE)
+    stream, _, decompressed = _compressed_stream(data)
+
+    def read_chunk(chunk: int) -> bytes:
+        stream.seek(chunk * DEFAULT_CHUNK_SIZE + 1)
+        return stream.read(1)
+
+    for chunk in range(CHUNK_CACHE_SIZE):
+        assert read_chunk(chunk) == data[chunk * DEFAULT_CHUNK_SIZE + 1 : chunk * DEFAULT_CHUNK_SIZE + 2]
+    assert len(stream._chunk_cache) == CHUNK_CACHE_SIZE
+    assert len(decompressed) == CHUNK_CACHE_SIZE
+
+    # Reading a cached chunk doesn't decompress it again, but marks it as most recently used
+    read_chunk(0)
+    assert len(decompressed) == CHUNK_CACHE_SIZE
+
+    # So the least recently used chunk is evicted instead
+    read_chunk(CHUNK_CACHE_SIZE)
+    assert len(stream._chunk_cache) == CHUNK_CACHE_SIZE
+    assert stream._chunks[0] in stream._chunk_cache
+    assert stream._chunks[1] not in stream._chunk_cache
+
+    stream.close()
+    assert not stream._chunk_cache
+
+
+def test_compressed_stream_prefetch() -> None:
+    num_chunks = 20
+    data = _data(num_chunks * DEFAULT_CHUNK_SIZE - 100)
+    stream, fh, decompressed = _compressed_stream(data)
+
+    # Non-sequential reads only fetch and decompress the chunks they touch
+    stream.seek(5 * DEFAULT_CHUNK_SIZE)
+    stream.read(100)
+    stream.seek(DEFAULT_CHUNK_SIZE)
+    stream.read(100)
+    assert len(decompressed) == 2
+    assert not stream._prefetch_cache
+
+    # Sequential reads fetch multiple chunks per read, but only decompress the chunks that are read
+    stream, fh, decompressed = _compressed_stream(data)
+    table_reads = fh.reads
+
+    result = []
+    while buf := stream.read(1000):
+        result.append(buf)
+
+    assert b"".join(result) == data
+    assert len(decompressed) == num_chunks
+    assert fh.reads - table_reads < num_chunks // 2
+
+
+def test_compressed_stream_hash_readinto() -> None:
+    data = _data(3 * DEFAULT_CHUNK_SIZE + 1000)
+    stream, _, _ = _compressed_stream(data)
+
+    assert stream.hash(hashlib.sha1()).digest() == hashlib.sha1(data).digest()
+    assert stream.tell() == 0
+
+    stream.seek(17611)
+    buf = bytearray(2 * DEFAULT_CHUNK_SIZE)
+    assert stream.readinto(buf) == len(buf)
+    assert buf == data[17611 : 17611 + len(buf)]
+    assert stream.tell() == 17611 + len(buf)
+    assert stream.read(10) == data[17611 + len(buf) : 17611 + len(buf) + 10]
+
+    stream.seek(len(data) - 10)
+    buf = bytearray(100)
+    assert stream.readinto(buf) == 10
+    assert buf[:10] == data[-10:]
+    assert stream.readinto(buf) == 0
+
+
+def _build_direntry(name: str, extra: bytes = b"") -> bytes:
+    name = name.encode("utf-16-le")
+    length = 102 + len(name) + 2 + len(extra)
+    entry = (
+        struct.pack(
+            "<qIIqqqqqq20s4sIIHHH",
+            length,
+            0x80,  # FILE_ATTRIBUTE.NORMAL
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            b"\x01" * 20,
+            b"",
+            0,
+            0,
+            0,
+            0,
+            len(name),
+        )
+        + name
+        + b"\x00\x00"
+        + extra
+    )
+    return entry + b"\x00" * (-len(entry) & 7)
+
+
+def test_direntry_hash_uncompressed(monkeypatch: pytest.MonkeyPatch) -> None:
+    entry = DirectoryEntry(None, memoryview(_build_direntry("file.txt")))
+
+    # Uncompressed resources are opened as regular streams, which are hashed with a read loop
+    data = _data(3 * DEFAULT_CHUNK_SIZE + 1000)
+    monkeypatch.setattr(entry, "open", lambda name="": io.BytesIO(data))
+    assert entry.hash(hashlib.sha1()).digest() == hashlib.sha1(data).digest()
+
+
+def test_direntry_fields() -> None:
+    buf = bytearray(_build_direntry("file.txt"))
+    buf[88:96] = b"\xfe" + b"\xff" * 7
+    entry = DirectoryEntry(None, memoryview(buf))
+
+    assert entry.name == "file.txt"
+    assert isinstance(entry.entry.Attributes, FILE_ATTRIBUTE)
+    assert entry.entry.Attributes == FILE_ATTRIBUTE.NORMAL
+    assert entry.entry.HardLink == -2
+
+
+def test_direntry_extra() -> None:
+    # Length ends right after the names, so there is no extra data
+    entry = DirectoryEntry(None, memoryview(_build_direntry("a.txt")))
+    assert entry.name == "a.txt"
+    assert entry.extra is None
+
+    # Length includes 4 bytes of trailing data
+    buf = bytearray(_build_direntry("file.txt", b"XYZW"))
+    entry = DirectoryEntry(None, memoryview(buf))
+    assert entry.entry.Length == 124
+    assert entry.extra == b"XYZW"
+    assert entry._next_offset == 128
+
+    # Length also includes the alignment padding
+    buf[0:8] = (128).to_bytes(8, "little")
+    entry = DirectoryEntry(None, memoryview(buf))
+    assert entry.extra == b"XYZW\x00\x00\x00\x00"
+    assert entry._next_offset == 128
+
+
+def test_wim_path_cache(basic_wim: BinaryIO, monkeypatch: pytest.MonkeyPatch) -> None:
+    image = next(WIM(basic_wim).images())
+    assert not image._path_cache
+
+    directory = image.get("dir")
+    entry = image.get("dir/another.txt")
+    assert image._path_cache == {"dir": directory, "dir\\another.txt": entry}
+
+    # Lookups relative to an entry bypass the cache
+    assert image.get("another.txt", directory) is entry
+    assert "another.txt" not in image._path_cache
+
+    # Misses are not cached
+    with pytest.raises(FileNotFoundError):
+        image.get("dir/nonexistent.txt")
+    assert "dir\\nonexistent.txt" not in image._path_cache
+
+    # Cached lookups don't walk the directory tree, and equivalent spellings share a cache entry
+    monkeypatch.setattr(image, "root", None)
+    for path in ("dir/another.txt", "dir\\another.txt", "/dir/another.txt", "./dir//another.txt", "dir/./another.txt/"):
+        assert image.get(path) is entry
+    for path in ("dir", "dir/", "\\dir", "./dir"):
+        assert image.get(path) is directory
+    assert len(image._path_cache) == 2
+
+
+def test_direntry_duplicate_names(monkeypatch: pytest.MonkeyPatch) -> None:
+    directory = DirectoryEntry(None, memoryview(_build_direntry("dir")))
+    first = DirectoryEntry(None, memoryview(_build_direntry("file.txt")))
+    second = DirectoryEntry(None, memoryview(_build_direntry("file.txt")))
+
+    monkeypatch.setattr(DirectoryEntry, "is_dir", lambda self: True)
+    directory.__dict__["_entries"] = [first, second]
+    assert directory._children["file.txt"] is first